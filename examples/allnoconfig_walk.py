@@ -27,13 +27,12 @@ def do_allnoconfig(node):
 
             # Is the symbol a non-allnoconfig_y symbol that can be set to a
             # lower value than its current value?
-            if (not sym.is_allnoconfig_y and
-                sym.assignable and
-                sym.assignable[0] < sym.tri_value):
-
-                # Yup, lower it
-                sym.set_value(sym.assignable[0])
-                changed = True
+            if not sym.is_allnoconfig_y:
+                assignable = sym.assignable
+                if assignable and assignable[0] < sym.tri_value:
+                    # Yup, lower it
+                    sym.set_value(assignable[0])
+                    changed = True
 
         # Recursively lower children
         if node.list:
@@ -55,6 +54,11 @@ while True:
     # symbols to be lowered, e.g. if a later symbol 'select's an earlier
     # symbol. To handle such situations, we do additional passes over the tree
     # until we're no longer able to change the value of any symbol in a pass.
+    #
+    # The additional passes are cheap. Kconfiglib caches 'assignable' and
+    # 'tri_value', and set_value() only invalidates the cached values of
+    # symbols that depend on the changed symbol, so only those get
+    # recalculated.
     changed = False
 
     do_allnoconfig(kconf.top_node)
@@ -35,16 +35,30 @@
 # All tests should pass. Report regressions to ulfalizer a.t Google's email
 # service.
 
+from __future__ import print_function
+
 import difflib
 import errno
+import gc
+import hashlib
+import multiprocessing
 import os
+import pickle
 import re
 import shutil
 import subprocess
 import sys
 import tempfile
 import textwrap
+import threading
+
+try:
+    # Python 2. Accepts 'str', which is what print() writes there.
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
 
+import kconfiglib
 from kconfiglib import Kconfig, Symbol, Choice, COMMENT, MENU, MenuNode, \
                        BOOL, TRISTATE, HEX, \
                        TRI_TO_STR, \
@@ -55,13 +69,34 @@ from kconfiglib import Kconfig, Symbol, Choice, COMMENT, MENU, MenuNode, \
                        KconfigError
 
 
+# The output of shell commands is discarded by redirecting it to /dev/null,
+# which is cheaper than reading it from a pipe. Python 2 has no
+# subprocess.DEVNULL, so open /dev/null once there instead of once per command.
+try:
+    devnull = subprocess.DEVNULL
+except AttributeError:
+    devnull = open(os.devnull, "w")
+
+
 def shell(cmd):
-    with open(os.devnull, "w") as devnull:
-        subprocess.call(cmd, shell=True, stdout=devnull, stderr=devnull)
+    subprocess.call(cmd, shell=True, stdout=devnull, stderr=devnull)
+
+
+def shell_async(cmd, env=None):
+    # Like shell(), but returns the subprocess.Popen instance for the command
+    # right away instead of waiting for it to finish. Call wait() on it to wait
+    # for it. 'env' is passed to subprocess.Popen().
+
+    return subprocess.Popen(cmd, shell=True, stdout=devnull, stderr=devnull,
+                            env=env)
 
 
 all_passed = True
 
+# Lines for the test_defconfig_fails log. The parent process writes them to
+# the file in a fixed order (see run_compatibility_tests()).
+defconfig_fails = []
+
 
 def fail(msg=None):
     global all_passed
@@ -70,9 +105,13 @@ def fail(msg=None):
         print("fail: " + msg)
 
 
-def verify(cond, msg):
+def verify(cond, msg, *args):
+    # If 'args' are given, 'msg' is a format string for them. It only gets
+    # formatted if 'cond' is false, which avoids formatting messages (which
+    # might stringify symbols, etc.) for checks that pass.
+
     if not cond:
-        fail(msg)
+        fail(msg.format(*args) if args else msg)
 
 
 def verify_equal(x, y):
@@ -88,6 +127,21 @@ obsessive = False
 obsessive_min_config = False
 log = False
 
+# Absolute path to the kernel source tree. Set in run_compatibility_tests().
+# The compatibility tests run in per-process scratch directories and find the
+# Kconfig files via $srctree, like for an O=<dir> build.
+srctree = None
+
+# Hash of the Kconfig files in the kernel tree, kconfiglib.py, and the
+# environment variables they reference. Used as the key for the cached data in
+# .kconfiglib-cache/. Set in run_compatibility_tests().
+kconfig_hash = None
+
+# Hash of 'kconfig_hash' and the scripts/kconfig/conf binary. Used as the key
+# for cached test results, which also depend on the C tools. Set in
+# run_compatibility_tests().
+results_hash = None
+
 
 def run_tests():
     global obsessive, log
@@ -2731,6 +2785,8 @@ def run_compatibility_tests():
     # Runs tests on configurations from the kernel. Tests compability with the
     # C implementation by comparing outputs.
 
+    global srctree, kconfig_hash, results_hash
+
     # Referenced inside the kernel Kconfig files.
     #
     # The str() makes the type of the value 'str' on both Python 2 and Python 3,
@@ -2746,16 +2802,22 @@ def run_compatibility_tests():
             .decode("utf-8").rstrip()
     )
 
-    os.environ["srctree"] = "."
+    srctree = os.getcwd()
+    os.environ["srctree"] = srctree
     os.environ["CC"] = "gcc"
     os.environ["LD"] = "ld"
 
+    kconfig_hash = get_kconfig_hash()
+
 
     if not os.path.exists("scripts/kconfig/conf"):
         print("\nscripts/kconfig/conf does not exist -- running "
               "'make allnoconfig' to build it...")
         shell("make allnoconfig")
 
+    with open("scripts/kconfig/conf", "rb") as f:
+        results_hash = hashlib.sha256(kconfig_hash.encode("utf-8") +
+                                      f.read()).hexdigest()
 
     print("Running compatibility tests...\n")
 
@@ -2770,19 +2832,44 @@ def run_compatibility_tests():
                 test_allyesconfig,
                 test_sanity)
 
-    for test_fn in test_fns:
-        # The test description is taken from the docstring of the corresponding
-        # function
-        print(textwrap.dedent(test_fn.__doc__))
-
-        for arch, srcarch in all_arch_srcarch():
-            # Referenced inside the Kconfig files
-            os.environ["ARCH"] = arch
-            os.environ["SRCARCH"] = srcarch
-
-            rm_configs()
-
-            test_fn(arch, srcarch)
+    # The arches are tested in parallel. Each worker process gets a private
+    # scratch directory below 'workdirs' (see init_worker()), so that the
+    # .config files written by different workers don't collide.
+    workdirs = tempfile.mkdtemp()
+    pool = multiprocessing.Pool(
+        multiprocessing.cpu_count(), init_worker,
+        (workdirs, srctree, kconfig_hash, results_hash, obsessive,
+         obsessive_min_config, log))
+    try:
+        for test_fn in test_fns:
+            print(test_descriptions[test_fn])
+
+            tasks = [(test_fn, arch, srcarch)
+                     for arch, srcarch in all_arch_srcarch()]
+
+            # imap() hands out the tasks just like imap_unordered(), but
+            # returns the results in task order. Together with the sorted
+            # arches and defconfigs, this keeps the output and the log the
+            # same from run to run.
+            for output, passed, fails in pool.imap(run_test, tasks):
+                sys.stdout.write(output)
+                if not passed:
+                    fail()
+
+                if fails:
+                    with open(os.path.join(srctree, "test_defconfig_fails"),
+                              "a") as fail_log:
+                        fail_log.writelines(fails)
+    except:
+        # Don't wait for the remaining tasks on errors and Ctrl-C. The result
+        # of an interrupted task never arrives, so join() would hang.
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+        shutil.rmtree(workdirs)
 
     if all_passed:
         print("All selftests and compatibility tests passed")
@@ -2790,8 +2877,65 @@ def run_compatibility_tests():
         sys.exit("Some tests failed")
 
 
+def init_worker(workdirs, srctree_, kconfig_hash_, results_hash_, obsessive_,
+                obsessive_min_config_, log_):
+    # Runs once in each worker process. Moves the worker into a private
+    # scratch directory below 'workdirs' and sets the globals the tests use.
+    #
+    # The globals are passed in explicitly rather than inherited, because
+    # workers only inherit them when they're started with fork(). Python 3.14
+    # defaults to the 'forkserver' start method on Linux, and macOS uses
+    # 'spawn'.
+
+    global srctree, kconfig_hash, results_hash, obsessive, \
+           obsessive_min_config, log
+
+    srctree = srctree_
+    kconfig_hash = kconfig_hash_
+    results_hash = results_hash_
+    obsessive = obsessive_
+    obsessive_min_config = obsessive_min_config_
+    log = log_
+
+    os.chdir(tempfile.mkdtemp(dir=workdirs))
+
+
+def run_test(task):
+    # Runs a compatibility test for an arch in a worker process. Returns the
+    # output of the test, whether it passed, and the lines it logged to
+    # 'defconfig_fails'.
+
+    global all_passed, defconfig_fails
+
+    test_fn, arch, srcarch = task
+
+    # Referenced inside the Kconfig files. Each worker is a separate process,
+    # so this doesn't affect other workers.
+    os.environ["ARCH"] = arch
+    os.environ["SRCARCH"] = srcarch
+
+    rm_configs()
+
+    all_passed = True
+    defconfig_fails = []
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        test_fn(arch, srcarch)
+        return sys.stdout.getvalue(), all_passed, defconfig_fails
+    finally:
+        sys.stdout = stdout
+
+        # Kconfig instances are full of reference cycles (e.g. between menu
+        # nodes and their parents), so they aren't freed when the test
+        # returns. Free them right away instead of whenever the garbage
+        # collector gets around to it, so that at most one parsed Kconfig
+        # tree per worker is alive at a time.
+        gc.collect()
+
+
 def all_arch_srcarch():
-    for srcarch in os.listdir("arch"):
+    for srcarch in sorted(os.listdir("arch")):
         # arc and h8300 are currently broken with the C tools on linux-next as
         # well. Perhaps they require cross-compilers to be installed.
         #
@@ -2818,57 +2962,65 @@ def all_arch_srcarch():
 def test_allnoconfig(arch, srcarch):
     """
     Verify that allnoconfig.py generates the same .config as
-    'make allnoconfig', for each architecture. Runs the script via
-    'make scriptconfig'.
+    'make allnoconfig', for each architecture. Runs the script like
+    'make scriptconfig' would.
     """
-    shell("make scriptconfig SCRIPT=Kconfiglib/allnoconfig.py "
-          "PYTHONCMD='{}'".format(sys.executable))
-    shell("mv .config ._config")
-    shell("scripts/kconfig/conf --allnoconfig Kconfig")
+    # The script and the C tools write to different files and can run in
+    # parallel
+    script = start_script("allnoconfig.py")
+    generated = run_conf_cached("--allnoconfig", arch, srcarch)
+    script.wait()
 
-    compare_configs(arch)
+    if generated:
+        compare_configs(arch)
 
 
 def test_allnoconfig_walk(arch, srcarch):
     """
     Verify that examples/allnoconfig_walk.py generates the same .config as
-    'make allnoconfig', for each architecture. Runs the script via
-    'make scriptconfig'.
+    'make allnoconfig', for each architecture. Runs the script like
+    'make scriptconfig' would.
     """
-    shell("make scriptconfig SCRIPT=Kconfiglib/examples/allnoconfig_walk.py "
-          "PYTHONCMD='{}'".format(sys.executable))
-    shell("mv .config ._config")
-    shell("scripts/kconfig/conf --allnoconfig Kconfig")
+    # The script and the C tools write to different files and can run in
+    # parallel
+    script = start_script("examples/allnoconfig_walk.py")
+    generated = run_conf_cached("--allnoconfig", arch, srcarch)
+    script.wait()
 
-    compare_configs(arch)
+    if generated:
+        compare_configs(arch)
 
 
 def test_allmodconfig(arch, srcarch):
     """
     Verify that allmodconfig.py generates the same .config as
-    'make allmodconfig', for each architecture. Runs the script via
-    'make scriptconfig'.
+    'make allmodconfig', for each architecture. Runs the script like
+    'make scriptconfig' would.
     """
-    shell("make scriptconfig SCRIPT=Kconfiglib/allmodconfig.py "
-          "PYTHONCMD='{}'".format(sys.executable))
-    shell("mv .config ._config")
-    shell("scripts/kconfig/conf --allmodconfig Kconfig")
+    # The script and the C tools write to different files and can run in
+    # parallel
+    script = start_script("allmodconfig.py")
+    generated = run_conf_cached("--allmodconfig", arch, srcarch)
+    script.wait()
 
-    compare_configs(arch)
+    if generated:
+        compare_configs(arch)
 
 
 def test_allyesconfig(arch, srcarch):
     """
     Verify that allyesconfig.py generates the same .config as
-    'make allyesconfig', for each architecture. Runs the script via
-    'make scriptconfig'.
+    'make allyesconfig', for each architecture. Runs the script like
+    'make scriptconfig' would.
     """
-    shell("make scriptconfig SCRIPT=Kconfiglib/allyesconfig.py "
-          "PYTHONCMD='{}'".format(sys.executable))
-    shell("mv .config ._config")
-    shell("scripts/kconfig/conf --allyesconfig Kconfig")
+    # The script and the C tools write to different files and can run in
+    # parallel
+    script = start_script("allyesconfig.py")
+    generated = run_conf_cached("--allyesconfig", arch, srcarch)
+    script.wait()
 
-    compare_configs(arch)
+    if generated:
+        compare_configs(arch)
 
 
 def test_sanity(arch, srcarch):
@@ -2879,12 +3031,7 @@ def test_sanity(arch, srcarch):
     """
     print("For {}...".format(arch))
 
-    kconf = Kconfig()
-
-    for sym in kconf.defined_syms:
-        verify(sym._visited == 2,
-               "{} has broken dependency loop detection (_visited = {})"
-               .format(sym.name, sym._visited))
+    kconf = load_kconfig(arch, srcarch)
 
     kconf.modules
     kconf.defconfig_list
@@ -2913,17 +3060,17 @@ def test_sanity(arch, srcarch):
 
     # Python 2/3 compatible
     for key, sym in kconf.syms.items():
-        verify(isinstance(key, str), "weird key '{}' in syms dict".format(key))
+        verify(isinstance(key, str), "weird key '{}' in syms dict", key)
 
-        verify(not sym.is_constant, sym.name + " in 'syms' and constant")
+        verify(not sym.is_constant, "{} in 'syms' and constant", sym.name)
 
         verify(sym not in kconf.const_syms,
-               sym.name + " in both 'syms' and 'const_syms'")
+               "{} in both 'syms' and 'const_syms'", sym.name)
 
         for dep in sym._dependents:
             verify(not dep.is_constant,
-                   "the constant symbol {} depends on {}"
-                   .format(dep.name, sym.name))
+                   "the constant symbol {} depends on {}",
+                   dep.name, sym.name)
 
         sym.__repr__()
         sym.__str__()
@@ -2939,29 +3086,34 @@ def test_sanity(arch, srcarch):
         sym.user_value
         sym.visibility
 
-    for sym in kconf.defined_syms:
-        verify(sym.nodes, sym.name + " is defined but lacks menu nodes")
+    # unique_defined_syms avoids checking symbols defined in multiple
+    # locations more than once
+    for sym in kconf.unique_defined_syms:
+        verify(sym._visited == 2,
+               "{} has broken dependency loop detection (_visited = {})",
+               sym.name, sym._visited)
+
+        verify(sym.nodes, "{} is defined but lacks menu nodes", sym.name)
 
         verify(not (sym.orig_type not in (BOOL, TRISTATE) and sym.choice),
-               sym.name + " is a choice symbol but not bool/tristate")
+               "{} is a choice symbol but not bool/tristate", sym.name)
 
     for key, sym in kconf.const_syms.items():
         verify(isinstance(key, str),
-               "weird key '{}' in const_syms dict".format(key))
+               "weird key '{}' in const_syms dict", key)
 
         verify(sym.is_constant,
-               '"{}" is in const_syms but not marked constant'
-               .format(sym.name))
+               '"{}" is in const_syms but not marked constant', sym.name)
 
         verify(not sym.nodes,
-               '"{}" is constant but has menu nodes'.format(sym.name))
+               '"{}" is constant but has menu nodes', sym.name)
 
         verify(not sym._dependents,
-               '"{}" is constant but is a dependency of some symbol'
-               .format(sym.name))
+               '"{}" is constant but is a dependency of some symbol',
+               sym.name)
 
         verify(not sym.choice,
-               '"{}" is constant and a choice symbol'.format(sym.name))
+               '"{}" is constant and a choice symbol', sym.name)
 
         sym.__repr__()
         sym.__str__()
@@ -2979,12 +3131,12 @@ def test_sanity(arch, srcarch):
     for choice in kconf.choices:
         for sym in choice.syms:
             verify(sym.choice is choice,
-                   "{0} is in choice.syms but 'sym.choice' is not the choice"
-                   .format(sym.name))
+                   "{0} is in choice.syms but 'sym.choice' is not the choice",
+                   sym.name)
 
             verify(sym.type in (BOOL, TRISTATE),
-                   "{} is a choice symbol but is not a bool/tristate"
-                   .format(sym.name))
+                   "{} is a choice symbol but is not a bool/tristate",
+                   sym.name)
 
         choice.__str__()
         choice.__repr__()
@@ -3006,7 +3158,7 @@ def test_sanity(arch, srcarch):
         node.__str__()
         verify(isinstance(node.item, (Symbol, Choice)) or \
                node.item in (MENU, COMMENT),
-               "'{}' appeared as a menu item".format(node.item))
+               "'{}' appeared as a menu item", node.item)
 
         if node.list is not None:
             node = node.list
@@ -3027,15 +3179,17 @@ def test_sanity(arch, srcarch):
 def test_alldefconfig(arch, srcarch):
     """
     Verify that alldefconfig.py generates the same .config as
-    'make alldefconfig', for each architecture. Runs the script via
-    'make scriptconfig'.
+    'make alldefconfig', for each architecture. Runs the script like
+    'make scriptconfig' would.
     """
-    shell("make scriptconfig SCRIPT=Kconfiglib/alldefconfig.py "
-          "PYTHONCMD='{}'".format(sys.executable))
-    shell("mv .config ._config")
-    shell("scripts/kconfig/conf --alldefconfig Kconfig")
+    # The script and the C tools write to different files and can run in
+    # parallel
+    script = start_script("alldefconfig.py")
+    generated = run_conf_cached("--alldefconfig", arch, srcarch)
+    script.wait()
 
-    compare_configs(arch)
+    if generated:
+        compare_configs(arch)
 
 
 def test_defconfig(arch, srcarch):
@@ -3049,51 +3203,148 @@ def test_defconfig(arch, srcarch):
     With logging enabled, this test appends any failures to a file
     test_defconfig_fails in the root.
     """
-    kconf = Kconfig()
-
     if obsessive:
         defconfigs = []
 
         # Collect all defconfigs. This could be done once instead, but it's
         # a speedy operation comparatively.
-        for srcarch_ in os.listdir("arch"):
+        for srcarch_ in sorted(os.listdir(os.path.join(srctree, "arch"))):
             defconfigs.extend(defconfig_files(srcarch_))
     else:
-        defconfigs = defconfig_files(srcarch)
+        defconfigs = list(defconfig_files(srcarch))
 
-    # Test architecture for each defconfig
+    # Some arches have no defconfigs. Skip them rather than printing an empty
+    # line for them.
+    if not defconfigs:
+        return
 
-    for defconfig in defconfigs:
-        rm_configs()
+    kconf = load_kconfig(arch, srcarch)
 
-        kconf.load_config(defconfig)
-        kconf.write_config("._config")
-        shell("scripts/kconfig/conf --defconfig='{}' Kconfig".
-              format(defconfig))
+    # Results are cached by defconfig contents, as many defconfigs are
+    # identical (especially in obsessive mode, where all arches are tested
+    # with all defconfigs). 'passed' and 'failed' hold the SHA-256 hex digests
+    # of the contents. Passing results are also saved in .kconfiglib-cache/
+    # and reused by later runs, for as long as the Kconfig files, Kconfiglib,
+    # the C tools, and the environment variables referenced in the Kconfig
+    # files stay the same.
 
-        arch_defconfig_str = "  {:14}with {:60} ".format(arch, defconfig)
+    results_path = cache_path("defconfig-{}-{}-{}-{}".format(
+        arch, srcarch, results_hash[:16],
+        env_hash(kconfig_env(kconf.env_vars))[:16]))
 
-        if equal_configs():
-            print(arch_defconfig_str + "OK")
-        else:
-            print(arch_defconfig_str + "FAIL")
-            fail()
-            if log:
-                with open("test_defconfig_fails", "a") as fail_log:
-                    fail_log.write("{} with {} did not match\n"
+    passed = set()
+    try:
+        with open(results_path) as f:
+            passed.update(f.read().split())
+    except EnvironmentError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+    new_passed = []
+    failed = set()
+
+    # Test architecture for each defconfig. To keep the output short, each
+    # passing defconfig is shown as a '.' after the arch name. Failing
+    # defconfigs get a line of their own (after any diff).
+
+    arch_str = "  {:14}".format(arch)
+    sys.stdout.write(arch_str)
+
+    def report_fail(defconfig, diff):
+        # End the line with dots
+        print()
+
+        if diff:
+            print_config_diff(*diff)
+
+        defconfig = os.path.relpath(defconfig, srctree)
+        print("{}with {:60} FAIL".format(arch_str, defconfig))
+        fail()
+        if log:
+            defconfig_fails.append("{} with {} did not match\n"
                                    .format(arch, defconfig))
 
+        sys.stdout.write(arch_str)
+
+    def finish(conf, defconfig, digest, their_config, our_config):
+        # Waits for the C tools to finish for 'defconfig' and compares the
+        # output
+
+        conf.wait()
+
+        diff = read_configs(their_config, our_config)
+        if diff[0] == diff[1]:
+            passed.add(digest)
+            new_passed.append(digest)
+            sys.stdout.write(".")
+        else:
+            failed.add(digest)
+            report_fail(defconfig, diff)
+
+    # The defconfigs are pipelined: The C tools for a defconfig run in
+    # parallel with Kconfiglib both for that defconfig and for the next one,
+    # and the output is compared after that. 'pending' holds the arguments to
+    # finish() for the defconfig whose output hasn't been compared yet. The
+    # output files alternate between two sets of names so that the pending
+    # files don't get overwritten.
+    pending = None
+
+    for i, defconfig in enumerate(defconfigs):
+        with open(defconfig, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+
+        if pending and (digest == pending[2] or digest in passed or
+                        digest in failed):
+            # Get the pending result first, to reuse it and to report
+            # results in order
+            finish(*pending)
+            pending = None
+
+        if digest in passed:
+            sys.stdout.write(".")
+            continue
+
+        if digest in failed:
+            # Already reported with a diff
+            report_fail(defconfig, None)
+            continue
+
+        # If there's a pending defconfig, it's the previous one, so this
+        # doesn't clash with its files
+        their_config = ".config_{}".format(i % 2)
+        our_config = "._config_{}".format(i % 2)
+        rm_configs(their_config, our_config)
+
+        conf = start_conf("--defconfig='{}'".format(defconfig), their_config)
+        kconf.load_config(defconfig)
+        kconf.write_config(our_config)
+
+        if pending:
+            finish(*pending)
+        pending = (conf, defconfig, digest, their_config, our_config)
+
+    if pending:
+        finish(*pending)
+
+    print()
+
+    if new_passed:
+        # Only one worker tests a particular arch at a time, so appending is
+        # safe
+        with open(results_path, "a") as f:
+            f.write("".join(digest + "\n" for digest in new_passed))
+
 
 def test_min_config(arch, srcarch):
     """
     Verify that Kconfiglib generates the same .config as 'make savedefconfig'
     for each architecture/defconfig pair.
     """
-    kconf = Kconfig()
+    kconf = load_kconfig(arch, srcarch)
 
     if obsessive_min_config:
         defconfigs = []
-        for srcarch_ in os.listdir("arch"):
+        for srcarch_ in sorted(os.listdir(os.path.join(srctree, "arch"))):
             defconfigs.extend(defconfig_files(srcarch_))
     else:
         defconfigs = defconfig_files(srcarch)
@@ -3101,14 +3352,18 @@ def test_min_config(arch, srcarch):
     for defconfig in defconfigs:
         rm_configs()
 
+        # Not a hard link, as 'conf --savedefconfig=.config' overwrites .config
+        # in-place, which would modify the defconfig
+        shutil.copyfile(defconfig, ".config")
+
+        # Run the C tools in parallel with Kconfiglib
+        conf = start_conf("--savedefconfig=.config")
         kconf.load_config(defconfig)
         kconf.write_min_config("._config")
+        conf.wait()
 
-        shell("cp {} .config".format(defconfig))
-
-        shell("scripts/kconfig/conf --savedefconfig=.config Kconfig")
-
-        arch_defconfig_str = "  {:14}with {:60} ".format(arch, defconfig)
+        arch_defconfig_str = "  {:14}with {:60} ".format(
+            arch, os.path.relpath(defconfig, srctree))
 
         if equal_configs():
             print(arch_defconfig_str + "OK")
@@ -3116,44 +3371,402 @@ def test_min_config(arch, srcarch):
             print(arch_defconfig_str + "FAIL")
 
 
+# Test descriptions, taken from the docstrings of the test functions. Dedented
+# once here instead of each time a test is run.
+test_descriptions = {
+    test_fn: textwrap.dedent(test_fn.__doc__)
+    for test_fn in (test_allnoconfig,
+                    test_allnoconfig_walk,
+                    test_allmodconfig,
+                    test_allyesconfig,
+                    test_sanity,
+                    test_alldefconfig,
+                    test_defconfig,
+                    test_min_config)
+}
+
+
 #
 # Helper functions
 #
 
 
+def start_script(script):
+    # Starts the Kconfiglib script 'script' (relative to the Kconfiglib
+    # directory) on the top-level Kconfig file, like 'make scriptconfig' would,
+    # and returns the subprocess.Popen instance for it. The scripts find
+    # kconfiglib.py next to them.
+    #
+    # The script writes its output to ._config instead of .config, so that it
+    # can run in parallel with the C tools.
+
+    return shell_async(
+        "{} {} Kconfig".format(sys.executable,
+                               os.path.join(srctree, "Kconfiglib", script)),
+        dict(os.environ, KCONFIG_CONFIG="._config"))
+
+
+# Options to the C tools whose output only depends on the Kconfig files and
+# the C tools, which makes it cacheable
+cacheable_conf_options = ("--allnoconfig", "--allyesconfig", "--allmodconfig",
+                          "--alldefconfig")
+
+
+def run_conf_cached(options, arch, srcarch):
+    # Runs the C tools (scripts/kconfig/conf) on the top-level Kconfig file
+    # with the options in 'options', generating .config. The generated .config
+    # is cached in .kconfiglib-cache/ and copied from there if it's already
+    # been generated. Only works for the options in 'cacheable_conf_options'.
+    #
+    # On a cache miss, the outputs for all the options in
+    # 'cacheable_conf_options' are generated and cached in one go, with a
+    # single shell command, so that the other tests for the arch find theirs
+    # in the cache.
+    #
+    # The values of the environment variables referenced in the Kconfig files
+    # are saved along with the outputs, and the outputs are regenerated if
+    # any of them has changed, like for the cached Kconfig instances in
+    # load_kconfig().
+    #
+    # Returns True if .config was generated. Otherwise, the C tools failed,
+    # and the test is reported as failed.
+
+    env_path = cache_path("conf-{}-{}-{}.env".format(
+        arch, srcarch, results_hash[:16]))
+
+    try:
+        f = open(env_path, "rb")
+    except EnvironmentError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    else:
+        with f:
+            env = pickle.load(f)
+
+        if env == kconfig_env(env) and \
+           copy_cached_conf(options, arch, srcarch):
+            return True
+
+        # Remove the saved environment before regenerating, so that it can't
+        # end up pairing with outputs generated with another environment
+        os.remove(env_path)
+
+    # Each output is deleted if the C tools fail, so that only complete
+    # outputs get cached
+    conf = os.path.join(srctree, "scripts", "kconfig", "conf")
+    shell("; ".join(
+        "KCONFIG_CONFIG={0} {1} {2} Kconfig || rm -f {0}"
+        .format(batch_config(option), conf, option)
+        for option in cacheable_conf_options))
+
+    for option in cacheable_conf_options:
+        path = conf_cache_path(option, arch, srcarch)
+
+        # Copy to a temporary file and rename it into place so that no one
+        # sees a partially written file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        os.close(fd)
+        try:
+            shutil.copyfile(batch_config(option), tmp_path)
+        except EnvironmentError as e:
+            os.remove(tmp_path)
+            if e.errno != errno.ENOENT:
+                raise
+
+            # The C tools failed. Remove any output cached by an earlier run
+            # too, so that it isn't picked up below.
+            try:
+                os.remove(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            continue
+
+        os.rename(tmp_path, path)
+        os.remove(batch_config(option))
+
+    # Save the environment last, after all the outputs are in place. This
+    # uses the (possibly cached) Kconfig instance to find the variables that
+    # are referenced in the Kconfig files.
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(env_path))
+    with os.fdopen(fd, "wb") as f:
+        pickle.dump(kconfig_env(load_kconfig(arch, srcarch).env_vars), f,
+                    pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_path, env_path)
+
+    if copy_cached_conf(options, arch, srcarch):
+        return True
+
+    print("{:14}FAIL (scripts/kconfig/conf {} failed)".format(arch, options))
+    fail()
+    return False
+
+
+def copy_cached_conf(options, arch, srcarch):
+    # Copies the cached output of the C tools for 'options' to .config.
+    # Returns False if it isn't in the cache.
+
+    try:
+        shutil.copyfile(conf_cache_path(options, arch, srcarch), ".config")
+        return True
+    except EnvironmentError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return False
+
+
+def batch_config(option):
+    # Returns the configuration filename used for the output of the C tools
+    # for 'option' in run_conf_cached() (e.g. .config-allnoconfig)
+
+    return ".config-" + option.lstrip("-")
+
+
+def conf_cache_path(options, arch, srcarch):
+    # Returns the path to the cached output of the C tools for 'options'
+
+    return cache_path("conf-{}-{}-{}-{}.config".format(
+        arch, srcarch, options.lstrip("-"), results_hash[:16]))
+
+
+def start_conf(options, config=".config"):
+    # Starts the C tools (scripts/kconfig/conf) on the top-level Kconfig file
+    # with the options in 'options' and returns the subprocess.Popen instance
+    # for them. The C tools use 'config' as the configuration file.
+
+    return shell_async(
+        "{} {} Kconfig".format(
+            os.path.join(srctree, "scripts", "kconfig", "conf"), options),
+        dict(os.environ, KCONFIG_CONFIG=config))
+
+
 def defconfig_files(srcarch):
     # Yields a list of defconfig file filenames for a particular srcarch
-    # subdirectory (arch/<srcarch>/)
+    # subdirectory (arch/<srcarch>/). The filenames are absolute and come out
+    # sorted, so that runs are reproducible and their output and logs can be
+    # diffed (directory listings come out in arbitrary order).
+
+    srcarch_dir = os.path.join(srctree, "arch", srcarch)
+
+    # This is a single directory walk. os.walk() gets the file types from the
+    # directory listings (via os.scandir() on Python 3), so no separate
+    # stat()s are needed to check for arch/<arch>/defconfig and
+    # arch/<arch>/configs/. It yields nothing if 'srcarch_dir' isn't a
+    # directory.
+    for dirpath, dirnames, filenames in os.walk(srcarch_dir):
+        if dirpath == srcarch_dir:
+            # Some arches have a defconfig in the root of their arch/<arch>/
+            # directory
+            if "defconfig" in filenames:
+                yield os.path.join(dirpath, "defconfig")
+
+            # Assume all files in the arch/<arch>/configs/ directory (if it
+            # exists) are configurations. Don't descend into other
+            # directories.
+            dirnames[:] = ["configs"] if "configs" in dirnames else []
+        else:
+            dirnames.sort()
+            for filename in sorted(filenames):
+                yield os.path.join(dirpath, filename)
 
-    srcarch_dir = os.path.join("arch", srcarch)
 
-    # Some arches have a defconfig in the root of their arch/<arch>/ directory
-    root_defconfig = os.path.join(srcarch_dir, "defconfig")
-    if os.path.exists(root_defconfig):
-        yield root_defconfig
+def get_kconfig_hash():
+    # Returns a hash of all Kconfig* files in the kernel tree, kconfiglib.py,
+    # the Python version, and the environment variables set by
+    # run_compatibility_tests() (ARCH and SRCARCH are part of the cache
+    # filenames instead).
+    #
+    # Other environment variables referenced in the Kconfig files aren't known
+    # until the files have been parsed. load_kconfig() checks those
+    # separately.
 
-    # Assume all files in the arch/<arch>/configs/ directory (if it exists) are
-    # configurations
-    defconfigs_dir = os.path.join(srcarch_dir, "configs")
+    h = hashlib.sha256()
 
-    if not os.path.isdir(defconfigs_dir):
+    def add_file(path):
+        h.update(os.path.relpath(path, srctree).encode("utf-8") + b"\0")
+        with open(path, "rb") as f:
+            h.update(f.read())
+
+    for dirpath, dirnames, filenames in os.walk(srctree):
+        # Sort to get a stable order, and skip e.g. .git/ and the cache
+        dirnames[:] = sorted(dirname for dirname in dirnames
+                             if not dirname.startswith(".") and
+                                dirname != "Kconfiglib")
+
+        for filename in sorted(filenames):
+            if filename.startswith("Kconfig"):
+                add_file(os.path.join(dirpath, filename))
+
+    # Might point to a .pyc file on Python 2
+    add_file(os.path.splitext(kconfiglib.__file__)[0] + ".py")
+
+    # The pickle format differs between Python versions
+    h.update(sys.version.encode("utf-8") + b"\0")
+
+    for var in "KERNELVERSION", "CC_VERSION_TEXT", "CC", "LD":
+        h.update("{}={}\0".format(var, os.environ[var]).encode("utf-8"))
+
+    return h.hexdigest()
+
+
+def cache_path(filename):
+    # Returns the path to 'filename' in the .kconfiglib-cache/ directory in the
+    # kernel root. Delete the directory to clear the cache.
+
+    cache_dir = os.path.join(srctree, ".kconfiglib-cache")
+    try:
+        os.makedirs(cache_dir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    return os.path.join(cache_dir, filename)
+
+
+# Kconfig instances store bound match() methods of compiled regexes, which
+# Python 2 can't pickle. Set to False as well if pickling fails on Python 3
+# (see pickle_kconfig()), so that it's only attempted once per process.
+can_pickle = sys.version_info[0] >= 3
+
+
+def load_kconfig(arch, srcarch):
+    # Returns a fresh Kconfig instance for the kernel Kconfig files. Parsing
+    # them is slow (e.g. due to $(shell,...) calls that run the compiler), so
+    # the parsed Kconfig instance is cached in .kconfiglib-cache/ and loaded
+    # from there if the Kconfig files haven't changed.
+    #
+    # Each call returns a new instance, so no state carries over between tests
+    # and nothing needs to be reset. Within a test,
+    # Kconfig.load_config(replace=True) already only resets the symbols that
+    # the previous configuration file set.
+    #
+    # The cached instance also includes what Kconfiglib derives from the
+    # parsed files, like the Symbol/Choice._dependents reverse dependency sets
+    # used for value invalidation, so neither those nor the dependency loop
+    # check that walks them is redone when loading from the cache.
+    #
+    # If Kconfig instances can't be pickled, the Kconfig files are parsed each
+    # time.
+
+    if not can_pickle:
+        return Kconfig()
+
+    path = cache_path("{}-{}-{}.pkl".format(arch, srcarch, kconfig_hash[:16]))
+
+    try:
+        f = open(path, "rb")
+    except EnvironmentError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    else:
+        with f:
+            env, kconf = pickle.load(f)
+
+        # Reparse if any of the environment variables referenced in the
+        # Kconfig files has changed since the instance was cached
+        if env == kconfig_env(env):
+            return kconf
+
+    kconf = Kconfig()
+    pickle_kconfig(kconf, path)
+    return kconf
+
+
+def kconfig_env(env_vars):
+    # Returns a dictionary with the current values of the environment
+    # variables in 'env_vars' (None for unset variables).
+    #
+    # Kconfig.env_vars only includes variables that were set during parsing,
+    # so setting a previously unset variable that's referenced in the Kconfig
+    # files isn't detected. Delete .kconfiglib-cache/ in that case.
+
+    return dict((var, os.environ.get(var)) for var in env_vars)
+
+
+def env_hash(env):
+    # Returns a hash of 'env', a dictionary returned by kconfig_env()
+
+    return hashlib.sha256(repr(sorted(env.items())).encode("utf-8")).hexdigest()
+
+
+def pickle_kconfig(kconf, path):
+    # Pickles 'kconf' to the cache file 'path', along with the values of the
+    # environment variables referenced in the Kconfig files (see
+    # load_kconfig()). Does nothing if 'kconf' can't be pickled.
+
+    global can_pickle
+
+    # Bound method for the (closed) top-level Kconfig file. Only used during
+    # parsing, and can't be pickled.
+    del kconf._readline
+
+    try:
+        pickled = run_with_big_stack(
+            pickle.dumps, (kconfig_env(kconf.env_vars), kconf),
+            pickle.HIGHEST_PROTOCOL)
+    except (RuntimeError, pickle.PicklingError):
+        # Pickling recurses deeply (see run_with_big_stack()). Python 3.12
+        # and later have a fixed recursion limit for C code like the _pickle
+        # module, which the kernel Kconfig files exceed regardless of the
+        # stack size and sys.setrecursionlimit(). This raises RecursionError,
+        # a subclass of RuntimeError.
+        can_pickle = False
         return
 
-    for dirpath, _, filenames in os.walk(defconfigs_dir):
-        for filename in filenames:
-            yield os.path.join(dirpath, filename)
+    # Several workers might parse the same arch at the same time. Write to a
+    # temporary file and rename it into place so that no one sees a partially
+    # written file.
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, "wb") as f:
+        f.write(pickled)
+    os.rename(tmp_path, path)
 
 
-def rm_configs():
-    # Delete any old ".config" (generated by the C implementation) and
-    # "._config" (generated by us), if present.
+def run_with_big_stack(fn, *args):
+    # Calls fn(*args) in a thread with a large stack and a raised recursion
+    # limit, and returns the result. Pickling recurses through long
+    # MenuNode.next chains and the like, which would overflow the default
+    # stack for the kernel Kconfig files.
+
+    res = []
+    exc_info = []
+
+    def run():
+        try:
+            res.append(fn(*args))
+        except BaseException:
+            exc_info.append(sys.exc_info())
+
+    old_stack_size = threading.stack_size(512*1024*1024)
+    old_limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(200000)
+    try:
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+    finally:
+        threading.stack_size(old_stack_size)
+        sys.setrecursionlimit(old_limit)
+
+    if exc_info:
+        # Re-raise the exception in this thread
+        raise exc_info[0][1]
+
+    return res[0]
 
-    def rm_if_exists(f):
-        if os.path.exists(f):
-            os.remove(f)
 
-    rm_if_exists(".config")
-    rm_if_exists("._config")
+def rm_configs(their_config=".config", our_config="._config"):
+    # Delete any old 'their_config' (generated by the C implementation) and
+    # 'our_config' (generated by us), if present.
+
+    for f in their_config, our_config:
+        # Just try to remove the file instead of checking if it exists first,
+        # which saves a stat() per file
+        try:
+            os.remove(f)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
 
 
 def compare_configs(arch):
@@ -3164,39 +3777,68 @@ def compare_configs(arch):
         fail()
 
 
+# Matches '# CONFIG_FOO is not set' lines in .config files. Compiled once
+# instead of relying on the re module's cache.
+_unset_match = re.compile(br"# CONFIG_(\w+) is not set").match
+
+
 def equal_configs():
-    with open(".config") as f:
-        their = f.readlines()
-
-    # Strip the header generated by 'conf'
-    i = 0
-    for line in their:
-        if not line.startswith("#") or \
-           re.match(r"# CONFIG_(\w+) is not set", line):
-            break
-        i += 1
-    their = their[i:]
+    # Returns True if .config (generated by the C tools) and ._config
+    # (generated by us) are equal. Prints a diff otherwise.
+
+    their, our = read_configs()
+    if their == our:
+        return True
+
+    print_config_diff(their, our)
+    return False
+
+
+def read_configs(their_config=".config", our_config="._config"):
+    # Returns the contents of 'their_config' (generated by the C tools, minus
+    # the header generated by 'conf') and 'our_config' (generated by us) as a
+    # (<their contents>, <our contents>) tuple of byte strings. <our contents>
+    # is None if 'our_config' doesn't exist.
+    #
+    # The files are compared as single byte strings rather than as lists of
+    # lines, which is much faster. Lines are only split up for the diff if the
+    # files differ.
+
+    with open(their_config, "rb") as f:
+        # Skip the header generated by 'conf'
+        while True:
+            header_end = f.tell()
+            line = f.readline()
+            if not line.startswith(b"#") or _unset_match(line):
+                break
+
+        f.seek(header_end)
+        their = f.read()
 
     try:
-        f = open("._config")
+        f = open(our_config, "rb")
     except EnvironmentError as e:
         if e.errno != errno.ENOENT:
             raise
-        print("._config not found. Did you forget to apply the Makefile patch?")
-        return False
-    else:
-        with f:
-            our = f.readlines()
+        return (their, None)
 
-    if their == our:
-        return True
+    with f:
+        return (their, f.read())
 
-    # Print a unified diff to help debugging
-    print("Mismatched .config's! Unified diff:")
-    sys.stdout.writelines(difflib.unified_diff(their, our, fromfile="their",
-                                               tofile="our"))
 
-    return False
+def print_config_diff(their, our):
+    # Prints a unified diff between the configuration file contents returned
+    # by read_configs(), to help debugging
+
+    if our is None:
+        print("._config not found. Did the Kconfiglib script crash?")
+        return
+
+    print("Mismatched .config's! Unified diff:")
+    sys.stdout.writelines(difflib.unified_diff(
+        their.decode("utf-8").splitlines(True),
+        our.decode("utf-8").splitlines(True),
+        fromfile="their", tofile="our"))
 
 
 if __name__ == "__main__":